@@ -0,0 +1,235 @@
+# Author: Jab (or 40BlocksUnder) | Joshua Edwards
+# Link for more info: http://theindiestone.com/forums/index.php/topic/12864-blender
+# Builds the Blender data of a model from the arrays ZomboidFormat reads, and
+#     keeps track of the PZ armatures in a scene. Shared by both import
+#     scripts, which put this directory on sys.path before importing it.
+import hashlib,math,bpy
+import numpy
+
+from ZomboidFormat import changed_keys, decimate_keys
+
+
+# Builds the mesh data straight from flat arrays, with one foreach_set per
+#     attribute instead of from_pydata() and a bmesh loop over the UVs.
+# -- vertices: VERTEX_COUNT x XYZ
+# -- faces:    FACE_COUNT x 3 (Triangles)
+# -- face_uvs: FACE_COUNT x 3 x UV, or None
+def fill_mesh(mesh, vertices, faces, face_uvs=None):
+    vertices   = numpy.ascontiguousarray(vertices, dtype=numpy.float32)
+    faces      = numpy.ascontiguousarray(faces, dtype=numpy.int32)
+    face_count = len(faces)
+    
+    mesh.vertices.add(len(vertices))
+    mesh.loops.add(face_count * 3)
+    mesh.polygons.add(face_count)
+    
+    mesh.vertices.foreach_set("co", vertices.ravel())
+    mesh.loops.foreach_set("vertex_index", faces.ravel())
+    mesh.polygons.foreach_set("loop_start", numpy.arange(0, face_count * 3, 3, dtype=numpy.int32))
+    mesh.polygons.foreach_set("loop_total", numpy.full(face_count, 3, numpy.int32))
+    
+    if face_uvs is not None and len(face_uvs):
+        # (Blender needs the texture layer for the UV layer to exist)
+        mesh.uv_textures.new()
+        uvs = numpy.ascontiguousarray(face_uvs, dtype=numpy.float32)
+        mesh.uv_layers.active.data.foreach_set("uv", uvs.ravel())
+    
+    mesh.update(calc_edges=True, calc_tessface=True)
+
+
+# Creates one vertex group per bone and sets the weights from the per
+#     vertex influence arrays. The influences are sorted by bone and weight
+#     once, so each group gets a single add() call per distinct weight
+#     instead of one call per vertex.
+# -- bone_groups:    (Bone Index, Group Name) pairs, in group order
+# -- weight_indexes: VERTEX_COUNT x INFLUENCES (Bone Index)
+# -- weight_values:  VERTEX_COUNT x INFLUENCES (-1.0 when unused)
+def add_vertex_weights(obj, bone_groups, weight_indexes, weight_values):
+    weight_indexes = numpy.asarray(weight_indexes, dtype=numpy.int32)
+    weight_values  = numpy.asarray(weight_values, dtype=numpy.float32)
+    
+    groups = dict()
+    for bone_index, group_name in bone_groups:
+        groups[bone_index] = obj.vertex_groups.new(name=group_name)
+    
+    if not weight_indexes.size:
+        return
+    
+    vertices = numpy.repeat(numpy.arange(len(weight_indexes), dtype=numpy.int32), weight_indexes.shape[1])
+    indexes  = weight_indexes.ravel()
+    weights  = weight_values.ravel()
+    
+    used = weights != -1.0
+    vertices, indexes, weights = vertices[used], indexes[used], weights[used]
+    if not len(indexes):
+        return
+    
+    # A bone listed twice on one vertex keeps its last weight, as 'REPLACE'
+    #     did when the slots were added one at a time.
+    low   = int(indexes.min())
+    span  = int(indexes.max()) - low + 1
+    pairs = vertices.astype(numpy.int64) * span + (indexes - low)
+    last  = len(pairs) - 1 - numpy.unique(pairs[::-1], return_index=True)[1]
+    vertices, indexes, weights = vertices[last], indexes[last], weights[last]
+    
+    order = numpy.lexsort((weights, indexes))
+    vertices, indexes, weights = vertices[order], indexes[order], weights[order]
+    
+    # Start of each run of the same bone and weight.
+    starts = numpy.flatnonzero(numpy.concatenate(([True], (indexes[1:] != indexes[:-1]) | (weights[1:] != weights[:-1]))))
+    ends   = numpy.append(starts[1:], len(indexes))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        group = groups.get(int(indexes[start]))
+        if group is None:
+            continue
+        group.add(vertices[start:end].tolist(), float(weights[start]), 'REPLACE')
+
+
+# The F-Curve layout of the animated bones, worked out once and shared by
+#     every clip: (Bone Index, Group Name, Location Path, Rotation Path)
+def bake_layout(bone_names, bone_indexes):
+    layout = [ ]
+    for bone_index in bone_indexes:
+        bone_name = bone_names[bone_index]
+        data_path = 'pose.bones["' + bone_name + '"].'
+        layout.append((bone_index, bone_name, data_path + "location", data_path + "rotation_quaternion"))
+    return layout
+
+# Writes the location and rotation channels of each bone into the action's
+#     F-Curves directly, with one keyframe_points.add() and one
+#     foreach_set('co') per curve. A channel only gets keys where it
+#     changes (and on the frame before, so holds stay flat). With
+#     tolerances, keys that linear interpolation reproduces are dropped too
+#     and the curves are made linear.
+# -- layout:    bake_layout()
+# -- locations: FRAME_COUNT x BONE_ID x XYZ
+# -- rotations: FRAME_COUNT x BONE_ID x WXYZ
+def bake_action(action, layout, locations, rotations, frame_start=0, location_tolerance=None, angle_tolerance=None):
+    frame_count = len(locations)
+    if frame_count == 0 or not layout:
+        return
+    frames = numpy.arange(frame_start, frame_start + frame_count, dtype=numpy.float32)
+    
+    bone_indexes = [entry[0] for entry in layout]
+    loc = locations[:, bone_indexes]
+    rot = rotations[:, bone_indexes].astype(numpy.float64)
+    
+    # Keep neighbouring quaternions in the same hemisphere, so the curves
+    #     do not take the long way around between keys.
+    if frame_count > 1:
+        signs = numpy.where(numpy.sum(rot[1:] * rot[:-1], axis=-1) < 0.0, -1.0, 1.0)
+        rot[1:] *= numpy.cumprod(signs, axis=0)[..., None]
+    
+    loc_keys = changed_keys(loc)
+    rot_keys = changed_keys(rot)
+    linear   = location_tolerance != None or angle_tolerance != None
+    if location_tolerance != None:
+        loc_keys = decimate_keys(loc, loc_keys, location_tolerance)
+    if angle_tolerance != None:
+        rot_keys = decimate_keys(rot, rot_keys, angle_tolerance, rotation=True)
+    
+    for column, (bone_index, group_name, location_path, rotation_path) in enumerate(layout):
+        for data_path, values, keys in ((location_path, loc, loc_keys), (rotation_path, rot, rot_keys)):
+            keep = keys[:, column]
+            key_frames = frames[keep]
+            key_values = values[keep, column]
+            for index in range(0, values.shape[2]):
+                curve = action.fcurves.new(data_path, index=index, action_group=group_name)
+                curve.keyframe_points.add(len(key_frames))
+                co = numpy.empty((len(key_frames), 2), numpy.float32)
+                co[:, 0] = key_frames
+                co[:, 1] = key_values[:, index]
+                curve.keyframe_points.foreach_set("co", co.ravel())
+                if linear:
+                    # (Enum properties have no raw access, so no foreach_set)
+                    for point in curve.keyframe_points:
+                        point.interpolation = 'LINEAR'
+                curve.update()
+
+# Lays the actions end to end as strips on one new NLA track of the object.
+def add_nla_strips(obj, actions, track_name="Zomboid Animations"):
+    if obj.animation_data == None:
+        obj.animation_data_create()
+    track      = obj.animation_data.nla_tracks.new()
+    track.name = track_name
+    frame      = 0
+    for action in actions:
+        strip = track.strips.new(action.name, frame, action)
+        frame = int(math.ceil(strip.frame_end)) + 1
+
+
+# Deselects only the objects that are selected, instead of visiting every
+#     object in the scene.
+def deselect_objects():
+    for obj in bpy.context.selected_objects:
+        obj.select = False
+
+
+# Links a new object for 'data' into the scene, selected and active, and
+#     hands it back directly so nothing has to look it up by name.
+def add_object(scene, name, data):
+    obj = bpy.data.objects.new(name, data)
+    scene.objects.link(obj)
+    scene.objects.active = obj
+    obj.select           = True
+    return obj
+
+
+# Scene ID property indexing the PZ armatures: SIGNATURE -> OBJECT NAME
+ARMATURE_REGISTRY = "ZOMBOID_ARMATURES"
+
+
+# Identifies a skeleton by its bone names, in bone index order.
+def skeleton_signature(bone_names):
+    return hashlib.md5("\n".join(bone_names).encode("utf-8")).hexdigest()
+
+
+# Bone names of a PZ armature object, in the order of the bone ids stored on it.
+def armature_bone_names(obj):
+    bones = [bone.name for bone in obj.data.bones if bone.name in obj]
+    return sorted(bones, key=lambda bone_name: obj[bone_name])
+
+
+def register_armature(scene, obj, signature):
+    if ARMATURE_REGISTRY not in scene:
+        scene[ARMATURE_REGISTRY] = dict()
+    scene[ARMATURE_REGISTRY][signature] = obj.name
+    obj["ZOMBOID_SIGNATURE"]            = signature
+
+
+# Indexes every PZ armature in the file on the scene again, by the
+#     ZOMBOID_ARMATURE property the importers put on them.
+def index_armatures(scene):
+    scene[ARMATURE_REGISTRY] = dict()
+    for obj in bpy.data.objects:
+        if obj.type == 'ARMATURE' and obj.get("ZOMBOID_ARMATURE", -1) != -1:
+            register_armature(scene, obj, skeleton_signature(armature_bone_names(obj)))
+
+
+# Finds a PZ armature through the registry, by skeleton signature or the
+#     first one still valid. Stale entries are dropped on the way. When the
+#     registry has nothing (a scene made before it existed, an armature
+#     renamed or appended from another file since) the scene is indexed
+#     again once, the way the armatures used to be found.
+def find_armature(scene, signature=None):
+    if ARMATURE_REGISTRY in scene:
+        obj = lookup_armature(scene, signature)
+        if obj != None:
+            return obj
+    index_armatures(scene)
+    return lookup_armature(scene, signature)
+
+
+def lookup_armature(scene, signature=None):
+    registry = scene[ARMATURE_REGISTRY]
+    if signature != None:
+        keys = [signature] if signature in registry else []
+    else:
+        keys = list(registry.keys())
+    
+    for key in keys:
+        obj = bpy.data.objects.get(registry[key])
+        if obj != None and obj.type == 'ARMATURE' and obj.get("ZOMBOID_SIGNATURE") == key:
+            return obj
+        del registry[key]
+    return None
@@ -37,6 +37,8 @@ class ZomboidExportAnimation(Operator, ExportHelper):
         self.frame_count = get_frame_count(self.action)
         # Create Animation object.
         self.animation = Animation(self.action.name)
+        # Rest matrices of the bones. These do not change from frame to frame.
+        rest_pose = get_rest_pose(self.object)
         
         for index in range(self.frame_first, self.frame_last):
             # Sets the world to this frame.
@@ -47,15 +49,13 @@ class ZomboidExportAnimation(Operator, ExportHelper):
             for b in self.object.pose.bones:
                 bone = Bone(b.name, self.object[b.name])
                 
-                bip_offset = b.bone.matrix_local.copy()
-                bip_offset_inv = bip_offset.copy().inverted()
+                bip_offset, bip_offset_inv, loc1 = rest_pose[b.name]
 #               print('Offset Matrix: ')
 #               print(to_lwjgl_matrix(bip_offset_inv))
                 bip_basis = b.matrix_basis
                 
                 t1 = bip_basis * bip_offset_inv
                 
-                loc1 = (bip_offset).decompose()[0]
                 loc2 = (bip_basis.copy()).decompose()[0]
                 
                 loc = Vector((loc1[0] - loc2[2], loc1[1] + loc2[1], loc1[2] - loc2[0]))
@@ -444,6 +444,31 @@ class prettyfloat(float):
     def __repr__(self):
         return "%0.2f" % self
 
+# Rest matrices of each armature's bones, kept between exports:
+#     KEY: ARMATURE NAME -> (SIGNATURE, {BONE_NAME: (MATRIX_LOCAL, INVERTED, LOCATION)})
+REST_POSE_CACHE = dict()
+
+# Fingerprint of the armature's bones. Only editing the bones changes it.
+def armature_signature(armature):
+    signature = [ ]
+    for bone in armature.data.bones:
+        signature.append(bone.name)
+        for row in bone.matrix_local:
+            signature.extend(row)
+    return tuple(signature)
+
+def get_rest_pose(armature):
+    signature = armature_signature(armature)
+    cached    = REST_POSE_CACHE.get(armature.data.name)
+    if cached != None and cached[0] == signature:
+        return cached[1]
+    rest_pose = dict()
+    for bone in armature.data.bones:
+        matrix = bone.matrix_local.copy()
+        rest_pose[bone.name] = (matrix, matrix.inverted(), matrix.decompose()[0])
+    REST_POSE_CACHE[armature.data.name] = (signature, rest_pose)
+    return rest_pose
+
 def get_bone_id_table(armature):
     arm = armature.data
     bone_names = [bone.name for bone in arm.bones]
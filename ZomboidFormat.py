@@ -0,0 +1,1421 @@
+# Author: Jab (or 40BlocksUnder) | Joshua Edwards
+# Link for more info: http://theindiestone.com/forums/index.php/topic/12864-blender
+# Reads models from Zomboid format into plain NumPy containers. Nothing here
+#     imports Blender, so files can also be parsed by worker processes, tests
+#     and the asset pipeline. The import scripts build the Blender data from
+#     what these functions return.
+import traceback
+import fnmatch,hashlib,io,json,multiprocessing,os,tempfile
+import mmap,numpy
+import multiprocessing.spawn
+
+#####################################################################################
+###                                                                               ###
+###   Containers                                                                  ###
+###                                                                               ###
+#####################################################################################
+
+class ZMesh:
+    
+    __slots__ = (
+        'name', 'skeleton', 'animations', 'animation_count',
+        'version', 'element_count', 'elements', 'stride_type', 'vertex_count', 'face_count',
+        'vertices', 'uvs', 'faces', 'face_uvs', 'edges', 'weight_values', 'weight_indexes',
+        'object', 'mesh',
+        'has_texture', 'has_armature', 'load_armature', 'has_animations', 'has_weights',
+        'errors',
+        )
+    
+    def __init__(self):
+        
+        self.name             = ''
+        self.skeleton         = Skeleton()
+        self.animations       = [ ]
+        self.animation_count  = 0
+        
+        #############################
+        # FILE I/O              # # #
+        #############################
+        self.version        = 0
+        self.element_count  = 0
+        self.elements       = dict()                                # KEY: STRIDE_TYPE
+        self.stride_type    = [ ]
+        self.vertex_count   = 0
+        self.face_count     = 0
+        self.vertices       = numpy.zeros((0, 3), numpy.float32)    # VERTEX_COUNT x XYZ
+        self.uvs            = numpy.zeros((0, 2), numpy.float32)    # VERTEX_COUNT x UV
+        self.faces          = numpy.zeros((0, 3), numpy.int32)      # FACE_COUNT x VERTEX_ID
+        self.face_uvs       = numpy.zeros((0, 3, 2), numpy.float32) # FACE_COUNT x CORNER x UV
+        self.edges          = [ ]
+        self.weight_values  = numpy.zeros((0, 4), numpy.float32)    # VERTEX_COUNT x WEIGHT
+        self.weight_indexes = numpy.zeros((0, 4), numpy.int32)      # VERTEX_COUNT x BONE_ID
+        #############################
+        # BLENDER               # # #
+        #############################
+        self.object         = None
+        self.mesh           = None
+        #############################
+        # FLAGS                 # # #
+        #############################
+        self.has_texture    = False
+        self.has_armature   = False
+        self.load_armature  = False
+        self.has_animations = False
+        self.has_weights    = False
+        #############################
+        # PARSE ERRORS          # # #
+        #############################
+        self.errors         = [ ]    # TRACEBACKS
+
+class Skeleton:
+    
+    __slots__ = (
+        'name', 'bone_count', 'bone_index', 'bone_name', 'bone_parent', 'topology', 'bind_matrix', 'offset_matrix',
+        'animations', 'object', 'armature', 'bones', 'bind_pose',
+        )
+    
+    def __init__(self):
+        self.name          = ''
+        #############################
+        # FILE I/O              # # #
+        #############################
+        self.bone_count    = 0                                      # NUMBER OF BONES.
+        self.bone_index    = dict()                                 # KEY: BONE_NAME
+        self.bone_name     = [ ]                                    # INDEX: BONE_ID
+        self.bone_parent   = numpy.zeros(0, numpy.int32)            # INDEX: BONE_ID
+        self.topology      = None                                   # SkeletonTopology
+        self.bind_matrix   = numpy.zeros((0, 4, 4), numpy.float32)  # INDEX: BONE_ID
+        self.offset_matrix = numpy.zeros((0, 4, 4), numpy.float32)  # INDEX: BONE_ID
+        #############################
+        # BLENDER               # # #
+        #############################
+        self.animations    = [ ]    #
+        self.object        = None   #
+        self.armature      = None   #
+        self.bones         = [ ]    # INDEX: BONE_ID
+        self.bind_pose     = [ ]    # INDEX: BONE_ID
+        #############################
+
+class SkeletonTopology:
+    def __init__(self, parents):
+        # Built once from the bone hierarchy. (Parent index, -1 for a root)
+        parents          = numpy.array(parents, dtype=numpy.int32)
+        count            = len(parents)
+        self.bone_count  = count
+        self.parents     = parents                              # INDEX: BONE_ID
+        #############################
+        # CHILDREN (CSR)        # # #
+        #############################
+        # Children of bone i are child_index[child_start[i]:child_start[i + 1]],
+        #     in bone index order.
+        linked           = numpy.flatnonzero(parents >= 0)
+        self.child_index = linked[numpy.argsort(parents[linked], kind='mergesort')].astype(numpy.int32)
+        self.child_start = numpy.zeros(count + 1, numpy.int32)
+        numpy.cumsum(numpy.bincount(parents[linked], minlength=count), out=self.child_start[1:])
+        #############################
+        # LEVELS                # # #
+        #############################
+        # Breadth first from the roots: every bone comes after its parent in
+        #     'order', and each level only depends on the levels before it.
+        self.depth       = numpy.full(count, -1, numpy.int32)   # INDEX: BONE_ID
+        self.levels      = [ ]                                  # INDEX: DEPTH
+        level            = numpy.flatnonzero(parents < 0).astype(numpy.int32)
+        while len(level):
+            self.depth[level] = len(self.levels)
+            self.levels.append(level)
+            level = numpy.concatenate([self.children(bone_index) for bone_index in level.tolist()])
+        self.order       = numpy.concatenate(self.levels) if self.levels else numpy.zeros(0, numpy.int32)
+        #############################
+    
+    def children(self, bone_index):
+        return self.child_index[self.child_start[bone_index]:self.child_start[bone_index + 1]]
+    
+    def parent(self, bone_index):
+        return int(self.parents[bone_index])
+
+class Animation:
+    def __init__(self,name,time,key_count,bone_names):
+        self.name        = name
+        self.time        = time
+        self.key_count   = key_count
+        self.frame_count = 0
+        self.bone_names  = bone_names
+        #############################
+        # KEYS                  # # #
+        #############################
+        self.times       = None     # FRAME_COUNT x BONE_ID
+        self.locs        = None     # FRAME_COUNT x BONE_ID x XYZ
+        self.rots        = None     # FRAME_COUNT x BONE_ID x XYZW
+        self.keyed       = None     # FRAME_COUNT x BONE_ID
+        #############################
+
+
+
+#####################################################################################
+###                                                                               ###
+###   File I/O                                                                    ###
+###                                                                               ###
+#####################################################################################
+
+def read_header(file, z):
+    z.version       = read_float(file)
+    z.name          = read_line(file)
+    z.element_count = read_int(file)
+    read_int(file)
+    
+    for x in range(0, z.element_count):
+        value = read_line(file)
+        type  = read_line(file)
+        z.stride_type.append(type)
+        
+        if type == "TextureCoordArray":
+            z.has_texture = True
+        elif type == "BlendWeightArray":
+            z.has_weights = True
+
+
+def read_vertex_buffer(file, z):
+    z.vertex_count = read_int(file)
+    # Parse each stride element of the whole buffer in bulk.
+    store_vertex_arrays(z, read_stride_arrays(file, z.vertex_count, z.stride_type))
+
+
+def store_vertex_arrays(z, arrays):
+    z.elements = arrays
+    if "VertexArray" in arrays:
+        z.vertices = arrays["VertexArray"]
+    if "TextureCoordArray" in arrays:
+        uvs       = arrays["TextureCoordArray"]
+        uvs[:, 1] = 1.0 - uvs[:, 1]
+        z.uvs     = uvs
+    if "BlendWeightArray" in arrays:
+        z.weight_values  = arrays["BlendWeightArray"]
+    if "BlendIndexArray" in arrays:
+        z.weight_indexes = arrays["BlendIndexArray"].astype(numpy.int32)
+
+
+def read_faces(file, z):
+    z.face_count = read_int(file)
+    z.faces      = file.read_block(z.face_count, numpy.int32).reshape(z.face_count, 3)
+    if z.has_texture:
+        z.face_uvs = z.uvs[z.faces]
+
+
+def read_skeleton(file, z):
+    skeleton = z.skeleton
+    count    = skeleton.bone_count = read_int(file)
+    # (Int) Bone Index, (Int) Parent Index, (String) Bone Name
+    hierarchy            = file.read_lines(count * 3)
+    skeleton.bone_name   = [None] * count
+    skeleton.bone_parent = numpy.zeros(count, numpy.int32)
+    for bone_index, bone_parent_index, bone_name in zip(hierarchy[0::3], hierarchy[1::3], hierarchy[2::3]):
+        bone_index                       = int(bone_index)
+        skeleton.bone_index [bone_name ] = bone_index
+        skeleton.bone_name  [bone_index] = bone_name
+        skeleton.bone_parent[bone_index] = int(bone_parent_index)
+    skeleton.topology      = SkeletonTopology(skeleton.bone_parent)
+    skeleton.bind_matrix   = read_matrix_block(file, count)
+    # Inverse bind pose, not used.
+    read_matrix_block(file, count)
+    skeleton.offset_matrix = read_matrix_block(file, count)
+
+
+def read_animations(file, z, table, animation_names="*", debug=False):
+    skeleton = z.skeleton
+    z.animation_count = read_int(file)
+    # Only the animations asked for are decoded, the others are never read.
+    for animation_name, animation_time, byte_offset, line_index, animation_frame_count in table.animations:
+        if not match_names(animation_name, animation_names):
+            continue
+        # Skip past the name, time and frame count, the table has them.
+        file.seek(byte_offset, line_index)
+        file.skip_lines(3)
+        if debug:
+            print("Reading Animation: " + animation_name + "...")
+        
+        animation = Animation(animation_name,animation_time,animation_frame_count,skeleton.bone_name)
+        read_key_frames(file, animation, skeleton.bone_index)
+        z.animations.append(animation)
+
+
+# Same as read_animations(), with the clips decoded by worker processes. The
+#     section table gives where each clip starts and how many keys it has, so
+#     every clip gets its own rows of key arrays shared by the workers, and
+#     is parsed straight out of the file into them. The keys are then laid
+#     out by frame here.
+def read_animations_parallel(filepath, z, table, animation_names="*", process_count=0, executable=None, debug=False):
+    skeleton = z.skeleton
+    z.animation_count = table.sections["animations"][2]
+    clips  = [clip for clip in table.animations if match_names(clip[0], animation_names)]
+    starts = numpy.zeros(len(clips) + 1, numpy.int64)
+    numpy.cumsum([clip[4] for clip in clips], out=starts[1:])
+    total  = int(starts[-1])
+    
+    context = multiprocessing.get_context('spawn')
+    shared  = (
+        context.RawArray('i', total),       # KEY x BONE_INDEX
+        context.RawArray('f', total),       # KEY x TIME
+        context.RawArray('f', total * 3),   # KEY x XYZ
+        context.RawArray('f', total * 4),   # KEY x XYZW
+        )
+    indexes, times, locs, rots = shared_key_arrays(shared)
+    
+    jobs = [ ]
+    for clip_index, (animation_name, animation_time, byte_offset, line_index, key_count) in enumerate(clips):
+        jobs.append((clip_index, byte_offset, line_index, key_count, int(starts[clip_index])))
+    
+    animations = [None] * len(clips)
+    pool = process_pool(process_count, executable, init_key_worker, (filepath, shared))
+    try:
+        for clip_index, key_count, names in pool.imap_unordered(decode_clip_job, jobs):
+            animation_name, animation_time, byte_offset, line_index, animation_frame_count = clips[clip_index]
+            if debug:
+                print("Decoded Animation: " + animation_name + "...")
+            rows      = slice(int(starts[clip_index]), int(starts[clip_index]) + key_count)
+            animation = Animation(animation_name,animation_time,animation_frame_count,skeleton.bone_name)
+            store_keys(animation, skeleton.bone_index, indexes[rows], times[rows], locs[rows], rots[rows], names)
+            animations[clip_index] = animation
+    finally:
+        pool.close()
+        pool.join()
+    z.animations.extend(animations)
+
+
+def shared_key_arrays(shared):
+    indexes, times, locs, rots = shared
+    return (numpy.frombuffer(indexes, numpy.int32),
+            numpy.frombuffer(times, numpy.float32),
+            numpy.frombuffer(locs, numpy.float32).reshape(-1, 3),
+            numpy.frombuffer(rots, numpy.float32).reshape(-1, 4))
+
+
+# State of a key decoding worker, set once by the pool initializer.
+key_worker = dict()
+
+
+def init_key_worker(filepath, shared):
+    key_worker["filepath"] = filepath
+    key_worker["keys"]     = shared_key_arrays(shared)
+
+
+def decode_clip_job(job):
+    clip_index, byte_offset, line_index, key_count, start = job
+    with io.open(key_worker["filepath"], 'r') as file:
+        reader = MappedReader(file)
+        # Skip past the name, time and frame count.
+        reader.seek(byte_offset, line_index)
+        reader.skip_lines(3)
+        decoded = reader.read_keys(key_count)
+        reader.close()
+    
+    count   = min(len(decoded[0]), key_count)
+    for shared, values in zip(key_worker["keys"], decoded[:4]):
+        shared[start:start + count] = values[:count]
+    return clip_index, count, decoded[4]
+
+
+# Reads the sections of a model file that are asked for into a new ZMesh.
+# -- use_memory_map: Parse out of the mapped file. (False: load it all first,
+#                    only when every section and clip is read)
+# -- process_count:  Worker processes parsing large meshes and decoding the
+#                    animations. (0: one for each core, 1: all read here)
+# -- executable:     Python the workers start on. (None: the default one)
+def parse_file(filepath, load_model=True, load_armature=True, load_animations=True, animation_names="*", use_memory_map=True,
+               process_count=1, executable=None, debug=False):
+    z = ZMesh()
+    workers = process_count or multiprocessing.cpu_count()
+    # Where each section starts, so the reader can seek straight to it.
+    table = load_section_table(filepath)
+
+    # Sections that were not asked for are never decoded. The LineReader
+    #     decodes the whole file up front, so whenever something is skipped
+    #     (a section, or any of the clips) the mapped reader is used instead.
+    selected = [clip for clip in table.animations if match_names(clip[0], animation_names)]
+    skipping = not (load_model and load_armature and load_animations) or len(selected) < len(table.animations)
+
+    with io.open(filepath, 'r') as file:
+        if use_memory_map or skipping:
+            # Parse straight out of the mapped file.
+            reader = MappedReader(file)
+        else:
+            # Load the file once and parse from memory.
+            reader = LineReader(file)
+        
+        if table.seek(reader, "header"):
+            read_header(reader, z)
+        if load_model and workers > 1 and geometry_size(table, filepath) >= SHARD_MIN_SIZE:
+            read_geometry_parallel(filepath, z, table, workers, executable)
+        else:
+            if load_model and table.seek(reader, "vertices"):
+                read_vertex_buffer(reader, z)
+            if load_model and table.seek(reader, "faces"):
+                read_faces(reader, z)
+        # The animations are keyed on the armature, so they need it too.
+        if load_armature and table.seek(reader, "bones"):
+            try:
+                read_skeleton(reader, z)
+                z.has_armature = True
+                z.load_armature = True
+            except:
+                traceback.print_exc()
+                z.errors.append(traceback.format_exc())
+        if load_animations and z.has_armature and table.seek(reader, "animations"):
+            try:
+                if workers > 1 and animation_size(table, filepath, animation_names) >= SHARD_MIN_SIZE:
+                    read_animations_parallel(filepath, z, table, animation_names, workers, executable, debug)
+                else:
+                    read_animations(reader, z, table, animation_names, debug)
+                z.has_animations  = True
+            except: 
+                traceback.print_exc()
+                z.errors.append(traceback.format_exc())
+                
+        # Close the file.
+        reader.close()
+        file.close()
+    return z
+
+
+# Bytes of vertex and face text, or of selected animation keys, a file needs
+#     before it is worth starting worker processes for them.
+SHARD_MIN_SIZE = 1 << 24
+
+
+def geometry_size(table, filepath):
+    if "vertices" not in table.sections or "faces" not in table.sections:
+        return 0
+    if "bones" in table.sections:
+        end = table.sections["bones"][0]
+    else:
+        end = os.path.getsize(filepath)
+    return end - table.sections["vertices"][0]
+
+
+# Bytes of the animations asked for, each from its name line to the next one.
+def animation_size(table, filepath, animation_names="*"):
+    size = 0
+    for index, clip in enumerate(table.animations):
+        if not match_names(clip[0], animation_names):
+            continue
+        if index + 1 < len(table.animations):
+            end = table.animations[index + 1][2]
+        else:
+            end = os.path.getsize(filepath)
+        size += end - clip[2]
+    return size
+
+
+# Same as read_vertex_buffer() and read_faces(), with both sections cut into
+#     byte ranges of whole records (a vertex is one line for each stride
+#     element, a face one line). Worker processes parse the ranges straight
+#     into their rows of one shared array for each section, so there is
+#     nothing to join afterwards.
+def read_geometry_parallel(filepath, z, table, shard_count, executable=None):
+    with io.open(filepath, 'r') as file:
+        reader = MappedReader(file)
+        try:
+            table.seek(reader, "vertices")
+            z.vertex_count = read_int(reader)
+            element_count  = len(z.stride_type)
+            widths         = [len(line.split(",")) for line in reader.peek_lines(element_count)]
+            vertex_shards  = shard_records(reader, z.vertex_count, element_count, shard_count)
+            table.seek(reader, "faces")
+            z.face_count   = read_int(reader)
+            face_shards    = shard_records(reader, z.face_count, 1, shard_count)
+            
+            for start, end, first, count in vertex_shards + face_shards:
+                if reader.map.find(b"#", start, end) != -1:
+                    # Comments inside the sections, read them here instead.
+                    table.seek(reader, "vertices")
+                    read_vertex_buffer(reader, z)
+                    table.seek(reader, "faces")
+                    read_faces(reader, z)
+                    return
+        finally:
+            reader.close()
+    
+    context = multiprocessing.get_context('spawn')
+    shared  = {
+        "vertices" : (context.RawArray('f', z.vertex_count * sum(widths)), 'f', sum(widths)),
+        "faces"    : (context.RawArray('i', z.face_count * 3), 'i', 3),
+        }
+    jobs = [("vertices",) + shard for shard in vertex_shards] + [("faces",) + shard for shard in face_shards]
+    pool = process_pool(min(shard_count, len(jobs)), executable, init_range_worker, (filepath, shared))
+    try:
+        for name, first, count, parsed in pool.imap_unordered(parse_range_job, jobs):
+            if parsed != count * shared[name][2]:
+                raise ValueError("Expected " + str(count) + " records in the " + name + " section from record " + str(first) + ".")
+    finally:
+        pool.close()
+        pool.join()
+    
+    arrays = shared_range_arrays(shared)
+    store_vertex_arrays(z, split_stride_block(arrays["vertices"], widths, z.stride_type))
+    z.faces = arrays["faces"]
+    if z.has_texture:
+        z.face_uvs = z.uvs[z.faces]
+
+
+# Cuts 'count' records of 'record_lines' lines, from the reader's offset, into
+#     at most 'shard_count' byte ranges that start and end on a record:
+#     [(BYTE_START, BYTE_END, FIRST_RECORD, RECORD_COUNT)]
+def shard_records(reader, count, record_lines, shard_count):
+    shards    = [ ]
+    per_shard = max(1, -(-count // max(1, shard_count)))
+    for first in range(0, count, per_shard):
+        records = min(per_shard, count - first)
+        start   = reader.offset
+        end     = reader.find_lines(records * record_lines)
+        shards.append((start, end, first, records))
+        reader.seek(end, reader.line + records * record_lines)
+    return shards
+
+
+def shared_range_arrays(shared):
+    arrays = dict()
+    for name, (array, typecode, width) in shared.items():
+        arrays[name] = numpy.frombuffer(array, typecode).reshape(-1, width)
+    return arrays
+
+
+# State of a mesh range worker, set once by the pool initializer.
+range_worker = dict()
+
+
+def init_range_worker(filepath, shared):
+    range_worker["filepath"] = filepath
+    range_worker["arrays"]   = shared_range_arrays(shared)
+
+
+def parse_range_job(job):
+    name, start, end, first, count = job
+    rows   = range_worker["arrays"][name][first:first + count].reshape(-1)
+    parsed = 0
+    with io.open(range_worker["filepath"], 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Slice by slice, cut at line ends, like MappedReader.read_block().
+        while start < end:
+            stop = min(start + MAP_CHUNK_SIZE, end)
+            if stop < end:
+                stop = mapped.rfind(b"\n", start, stop) + 1
+            values = numpy.fromstring(mapped[start:stop].replace(b",", b" "), dtype=rows.dtype, sep=" ")
+            stored = max(0, min(len(values), len(rows) - parsed))
+            rows[parsed:parsed + stored] = values[:stored]
+            parsed += len(values)
+            start   = stop
+        mapped.close()
+    return name, first, count, parsed
+
+
+# Reads a model file like parse_file(), through the parse cache when there is
+#     a cache directory.
+def load_file(filepath, load_model=True, load_armature=True, load_animations=True, animation_names="*", use_memory_map=True,
+              process_count=1, executable=None, cache_directory=None, cache_size=0, debug=False):
+    cache = None
+    if cache_directory:
+        cache     = ParseCache(cache_directory, cache_size)
+        cache_key = cache.key(filepath, parse_options(load_model, load_armature, load_animations, animation_names))
+        z         = ZMesh()
+        if cache.load(cache_key, z):
+            if debug:
+                print("Loaded " + filepath + " from the parse cache.")
+            return z
+    
+    z = parse_file(filepath, load_model, load_armature, load_animations, animation_names, use_memory_map, process_count, executable, debug)
+    # A parse that failed partway is not kept, the next import tries again.
+    if cache != None and not z.errors:
+        cache.store(cache_key, z)
+    return z
+
+
+# Job of the batch import workers: (FILEPATH, load_file() ARGUMENTS). Errors
+#     are handed back rather than raised, so one bad file does not stop the
+#     others.
+def load_file_job(job):
+    filepath, arguments = job
+    try:
+        return filepath, load_file(filepath, **arguments), None
+    except Exception:
+        return filepath, None, traceback.format_exc()
+
+
+# Worker processes for parsing. They are spawned rather than forked, so they
+#     start from a plain interpreter that only imports this module. The
+#     executable (Blender passes its bundled Python) is only swapped in while
+#     the workers start, and put back right after.
+def process_pool(process_count=0, executable=None, initializer=None, initargs=()):
+    context  = multiprocessing.get_context('spawn')
+    previous = multiprocessing.spawn.get_executable()
+    if executable:
+        context.set_executable(executable)
+    try:
+        return context.Pool(process_count or None, initializer, initargs)
+    finally:
+        context.set_executable(previous)
+
+
+# What parse_file() reads from a file depends on these. (Part of the cache key)
+def parse_options(load_model=True, load_armature=True, load_animations=True, animation_names="*"):
+    return "model=%d armature=%d animations=%d names=%s" % (
+        load_model, load_armature, load_animations, animation_names)
+
+
+class LineReader:
+    
+    def __init__(self, file):
+        # Read the whole file in one go and drop the comment lines once, so
+        #     the read_* methods only have to step an index over the rest.
+        lines       = [line.strip() for line in file.read().splitlines()]
+        self.lines  = [line for line in lines if not line.startswith("#")]
+        self.offset = 0
+    
+    def read_line(self):
+        offset = self.offset
+        self.offset = offset + 1
+        try:
+            return self.lines[offset]
+        except IndexError:
+            # Past the end, act like readline() does at the end of a file.
+            return ''
+    
+    def peek_lines(self, count):
+        return self.lines[self.offset:self.offset + count]
+    
+    def read_lines(self, count):
+        offset = self.offset
+        self.offset = offset + count
+        return self.lines[offset:offset + count]
+    
+    def read_block(self, count, dtype):
+        # Parses every number on the next 'count' lines into one flat array.
+        text = " ".join(self.read_lines(count)).replace(",", " ")
+        return numpy.fromstring(text, dtype=dtype, sep=" ")
+    
+    def read_keys(self, count):
+        # The next 'count' key frames, as decode_keys() lays them out.
+        return decode_keys(self.read_lines(count * 5))
+    
+    def seek(self, byte_offset, line_index):
+        self.offset = line_index
+    
+    def skip_lines(self, count):
+        self.offset += count
+    
+    def close(self):
+        self.lines = [ ]
+
+
+# Size of the slices the MappedReader looks at in one go, and the bytes it
+#     first expects a line to take.
+MAP_CHUNK_SIZE  = 1 << 22
+MAP_LINE_SIZE   = 32
+# Key frames the MappedReader parses in one go, and the bytes it first
+#     expects each to take. (About a megabyte of text)
+KEY_RUN_COUNT   = 1 << 13
+KEY_RECORD_SIZE = 128
+
+class MappedReader:
+    
+    def __init__(self, file):
+        # Map the file rather than decoding it. Bytes are only looked at when
+        #     a section is read, and numeric blocks are parsed straight out of
+        #     the mapped buffer without building a string per line.
+        self.map    = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size   = len(self.map)
+        self.offset = 0
+        # Index of the next line, not counting comments. (Same as LineReader)
+        self.line   = 0
+    
+    def find_lines(self, count):
+        # Byte offset just past the next 'count' lines, found by counting the
+        #     newlines of large slices instead of stepping line by line. The
+        #     first slice is sized for the lines asked for, and grows from there.
+        position = self.offset
+        length   = min(MAP_CHUNK_SIZE, max(count, 256) * MAP_LINE_SIZE)
+        while count > 0 and position < self.size:
+            chunk = self.map[position:position + length]
+            found = chunk.count(b"\n")
+            if found < count:
+                count    -= found
+                position += len(chunk)
+                length    = min(MAP_CHUNK_SIZE, length * 2)
+                continue
+            if count < 64:
+                index = -1
+                for line in range(count):
+                    index = chunk.find(b"\n", index + 1)
+            else:
+                # Many lines, find every line end of the slice at once.
+                index = numpy.flatnonzero(numpy.frombuffer(chunk, numpy.uint8) == 10)[count - 1]
+            return position + int(index) + 1
+        return self.size
+    
+    def read_line(self):
+        while self.offset < self.size:
+            start = self.offset
+            end   = self.map.find(b"\n", start)
+            if end == -1:
+                end = self.size
+            self.offset = end + 1
+            line = self.map[start:end].strip()
+            if not line.startswith(b"#"):
+                self.line += 1
+                return line.decode()
+        return ''
+    
+    def peek_lines(self, count):
+        offset, line = self.offset, self.line
+        lines = self.read_lines(count)
+        self.seek(offset, line)
+        return lines
+    
+    def read_lines(self, count):
+        lines = [ ]
+        while len(lines) < count and self.offset < self.size:
+            start = self.offset
+            end   = self.offset = self.find_lines(count - len(lines))
+            for line in self.map[start:end].decode().splitlines():
+                line = line.strip()
+                if not line.startswith("#"):
+                    lines.append(line)
+        self.line += len(lines)
+        return lines
+    
+    def read_block(self, count, dtype):
+        start = self.offset
+        end   = self.find_lines(count)
+        if self.map.find(b"#", start, end) != -1:
+            # Comments inside the block, take the line by line path instead.
+            text = " ".join(self.read_lines(count)).replace(",", " ")
+            return numpy.fromstring(text, dtype=dtype, sep=" ")
+        
+        # Parse slice by slice, cut at line ends, so only one slice of raw
+        #     bytes exists next to the parsed values at any time.
+        parts = [ ]
+        while start < end:
+            stop = min(start + MAP_CHUNK_SIZE, end)
+            if stop < end:
+                stop = self.map.rfind(b"\n", start, stop) + 1
+            data = self.map[start:stop].replace(b",", b" ")
+            parts.append(numpy.fromstring(data, dtype=dtype, sep=" "))
+            start = stop
+        self.offset = end
+        self.line  += count
+        if not parts:
+            return numpy.zeros(0, dtype)
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+    
+    def read_keys(self, count):
+        # The next 'count' key frames, as decode_keys() lays them out, parsed
+        #     straight out of the mapped bytes. The name line of every key is
+        #     blanked out, so all the numbers of a run of keys parse in one
+        #     go. A name is only decoded for the first key of each bone index.
+        indexes = numpy.zeros(count, numpy.int32)
+        times   = numpy.zeros(count, numpy.float32)
+        locs    = numpy.zeros((count, 3), numpy.float32)
+        rots    = numpy.zeros((count, 4), numpy.float32)
+        names   = dict()
+        done    = 0
+        while done < count and self.offset < self.size:
+            records, values, starts, ends = self.parse_key_run(min(count - done, KEY_RUN_COUNT))
+            if values is None:
+                # Not a clean run of keys (comments, or cut short), the line
+                #     by line path sorts out what is there.
+                parsed = decode_keys(self.read_lines(records * 5))
+                length = min(len(column) for column in parsed[:4])
+                values = numpy.zeros((length, 9), numpy.float32)
+                values[:, 0], values[:, 1], values[:, 2:5], values[:, 5:9] = [column[:length] for column in parsed[:4]]
+                for index, bone_name in parsed[4].items():
+                    names.setdefault(index, bone_name)
+                starts = None
+            
+            rows = slice(done, done + len(values))
+            indexes[rows] = values[:, 0]
+            times  [rows] = values[:, 1]
+            locs   [rows] = values[:, 2:5]
+            rots   [rows] = values[:, 5:9]
+            if starts is not None:
+                for index, first in zip(*numpy.unique(indexes[rows], return_index=True)):
+                    if int(index) not in names:
+                        line = first * 5 + 1
+                        names[int(index)] = self.map[starts[line]:ends[line]].strip().decode()
+            done += len(values)
+            if len(values) < records:
+                break
+        return indexes[:done], times[:done], locs[:done], rots[:done], names
+    
+    def parse_key_run(self, records):
+        # Parses the next 'records' key frames in one go: (RECORDS, VALUES,
+        #     LINE_STARTS, LINE_ENDS), the values being KEY x (Bone Index,
+        #     Time, XYZ, XYZW). VALUES is None when the bytes do not hold
+        #     exactly that many keys, and the reader is left where it was.
+        start  = self.offset
+        length = records * KEY_RECORD_SIZE
+        while True:
+            # Grow the window until it holds all the lines, or the file ends.
+            stop = min(self.size, start + length)
+            view = numpy.frombuffer(self.map, numpy.uint8, stop - start, start)
+            data = view.copy()
+            del view
+            ends = numpy.flatnonzero(data == 10)
+            if len(ends) >= records * 5 or stop == self.size:
+                break
+            length *= 2
+        if len(ends) > records * 5:
+            stop = start + int(ends[records * 5 - 1]) + 1
+            data = data[:stop - start]
+            ends = ends[:records * 5]
+        if (data == 35).any():
+            return records, None, None, None
+        
+        if len(ends) < records * 5:
+            # The last line of the file has no line end.
+            ends = numpy.append(ends, len(data))
+        if len(ends) != records * 5:
+            return records, None, None, None
+        starts     = numpy.empty_like(ends)
+        starts[0]  = 0
+        starts[1:] = ends[:-1] + 1
+        
+        # Blank out the (non empty) name lines, then the commas.
+        names = (ends[1::5] > starts[1::5])
+        marks = numpy.zeros(len(data) + 1, numpy.int8)
+        marks[starts[1::5][names]] =  1
+        marks[ends  [1::5][names]] = -1
+        data[numpy.cumsum(marks[:-1], dtype=numpy.int8) > 0] = 32
+        data[data == 44] = 32
+        values = numpy.fromstring(data.tobytes(), dtype=numpy.float32, sep=" ")
+        if len(values) != records * 9:
+            return records, None, None, None
+        
+        self.offset = stop
+        self.line  += records * 5
+        return records, values.reshape(records, 9), starts + start, ends + start
+    
+    def seek(self, byte_offset, line_index):
+        self.offset = byte_offset
+        self.line   = line_index
+    
+    def tell(self):
+        return self.offset, self.line
+    
+    def skip_lines(self, count):
+        start = self.offset
+        end   = self.find_lines(count)
+        if self.map.find(b"#", start, end) != -1:
+            # Comments inside the block have to be stepped over.
+            self.read_lines(count)
+        else:
+            self.offset = end
+            self.line  += count
+    
+    def close(self):
+        self.map.close()
+
+
+class SectionTable:
+    
+    def __init__(self):
+        # KEY: SECTION_NAME -> [BYTE_OFFSET, LINE_INDEX, COUNT]
+        self.sections   = dict()
+        # [NAME, TIME, BYTE_OFFSET, LINE_INDEX, KEY_FRAME_COUNT]
+        self.animations = [ ]
+    
+    def mark(self, name, position, count):
+        self.sections[name] = [position[0], position[1], count]
+    
+    def seek(self, reader, name):
+        section = self.sections.get(name)
+        if section is None:
+            return False
+        reader.seek(section[0], section[1])
+        return True
+
+
+# Sections are in this order. The ones holding a count start at the count line.
+#     header:            Version, Model Name, Stride Element Count, Stride Size
+#     stride:            (Int) Offset, (String) Type         x Stride Element Count
+#     vertices:          Vertex Count, Vertex Buffer
+#     faces:             Face Count, Face Data
+#     bones:             Bone Count, Bone Hierarchy
+#     bind_pose:         (Int) Bone Index, (Matrix)          x Bone Count
+#     inverse_bind_pose: (Int) Bone Index, (Matrix)          x Bone Count
+#     offsets:           (Int) Bone Index, (Matrix)          x Bone Count
+#     animations:        Animation Count, then each Animation from its name line.
+def scan_sections(file):
+    reader = MappedReader(file)
+    table  = SectionTable()
+    try:
+        table.mark("header", reader.tell(), 1)
+        reader.read_line()
+        reader.read_line()
+        element_count = int(reader.read_line())
+        reader.read_line()
+        table.mark("stride", reader.tell(), element_count)
+        reader.skip_lines(element_count * 2)
+        
+        position     = reader.tell()
+        vertex_count = int(reader.read_line())
+        table.mark("vertices", position, vertex_count)
+        reader.skip_lines(vertex_count * element_count)
+        
+        position   = reader.tell()
+        face_count = int(reader.read_line())
+        table.mark("faces", position, face_count)
+        reader.skip_lines(face_count)
+        
+        position   = reader.tell()
+        bone_count = int(reader.read_line())
+        table.mark("bones", position, bone_count)
+        reader.skip_lines(bone_count * 3)
+        for name in ("bind_pose", "inverse_bind_pose", "offsets"):
+            table.mark(name, reader.tell(), bone_count)
+            reader.skip_lines(bone_count * 5)
+        
+        position        = reader.tell()
+        animation_count = int(reader.read_line())
+        table.mark("animations", position, animation_count)
+        for index in range(0, animation_count):
+            position       = reader.tell()
+            name           = reader.read_line()
+            time           = float(reader.read_line())
+            key_count      = int(reader.read_line())
+            table.animations.append([name, time, position[0], position[1], key_count])
+            reader.skip_lines(key_count * 5)
+    except ValueError:
+        # End of the file, or the sections stop here.
+        ok = None
+    reader.close()
+    return table
+
+
+def load_section_table(filepath):
+    # The table is cached next to the model file, and scanned again once the
+    #     file changes.
+    stat       = os.stat(filepath)
+    cache_path = filepath + ".toc"
+    try:
+        with io.open(cache_path, 'r') as file:
+            cache = json.load(file)
+        if cache["size"] == stat.st_size and cache["mtime"] == stat.st_mtime:
+            table = SectionTable()
+            table.sections   = cache["sections"]
+            table.animations = cache["animations"]
+            return table
+    except (IOError, OSError, ValueError, KeyError):
+        ok = None
+    
+    with io.open(filepath, 'r') as file:
+        table = scan_sections(file)
+    
+    try:
+        with io.open(cache_path, 'w') as file:
+            file.write(json.dumps({
+                "size"       : stat.st_size,
+                "mtime"      : stat.st_mtime,
+                "sections"   : table.sections,
+                "animations" : table.animations,
+                }))
+    except (IOError, OSError):
+        # Read-only folder, the table is just not cached.
+        ok = None
+    return table
+
+
+def read_line(file):
+    return file.read_line()
+  
+                  
+
+
+def read_int(file):
+    return int(file.read_line())
+
+
+def read_float(file):
+    return float(file.read_line())
+
+
+def read_stride_arrays(file, vertex_count, stride_types):
+    # Every vertex has the same layout, so the width of each stride element
+    #     is taken from the first vertex and the whole buffer is parsed at once.
+    stride_lines = file.peek_lines(len(stride_types))
+    widths       = [len(line.split(",")) for line in stride_lines]
+    block        = file.read_block(vertex_count * len(stride_types), numpy.float32)
+    return split_stride_block(block.reshape(vertex_count, sum(widths)), widths, stride_types)
+
+
+# The columns of each stride element of a VERTEX_COUNT x STRIDE block.
+def split_stride_block(block, widths, stride_types):
+    arrays = dict()
+    column = 0
+    for element, type in enumerate(stride_types):
+        width = widths[element]
+        arrays[type] = numpy.ascontiguousarray(block[:, column:column + width])
+        column += width
+    return arrays
+
+
+def read_matrix_block(file, count):
+    # (Int) Bone Index followed by a (Matrix) for each bone, stored by bone id.
+    lines    = file.read_lines(count * 5)
+    bone_ids = [int(line) for line in lines[0::5]]
+    del lines[0::5]
+    values   = numpy.fromstring(" ".join(lines).replace(",", " "), dtype=numpy.float32, sep=" ")
+    matrices = numpy.zeros((count, 4, 4), numpy.float32)
+    matrices[bone_ids] = values.reshape(count, 4, 4)
+    return matrices
+
+
+def match_names(name, patterns):
+    # Patterns are separated by commas. (e.g. "Run, Walk*")
+    for pattern in patterns.split(","):
+        if fnmatch.fnmatchcase(name, pattern.strip()):
+            return True
+    return False
+
+
+# Key Frames:
+# -- (Int)        Bone Index
+# -- (String)     Bone Name
+# -- (Float)      Time in Seconds
+# -- (Vector3)    Translation
+# -- (Quaternion) Rotation
+def read_key_frames(file, animation, bone_ids):
+    store_keys(animation, bone_ids, *file.read_keys(animation.key_count))
+
+
+# Parses the lines of key frames into flat arrays, one row for each key:
+#     (Bone Index, Time, Translation, Rotation, BONE_INDEX -> BONE_NAME)
+# The bone name is only looked at once for each bone index.
+def decode_keys(lines):
+    
+    def parse(column, dtype):
+        text = " ".join(lines[column::5]).replace(",", " ")
+        return numpy.fromstring(text, dtype=dtype, sep=" ")
+    
+    indexes = parse(0, numpy.int32)
+    times   = parse(2, numpy.float32)
+    locs    = parse(3, numpy.float32).reshape(-1, 3)
+    rots    = parse(4, numpy.float32).reshape(-1, 4)
+    
+    names = dict()
+    for index, first in zip(*numpy.unique(indexes, return_index=True)):
+        names[int(index)] = lines[first * 5 + 1]
+    return indexes, times, locs, rots, names
+
+
+# Lays the keys from decode_keys() out by frame on the animation.
+def store_keys(animation, bone_ids, indexes, times, locs, rots, names):
+    # A new frame starts each time the bone index goes back down.
+    frame_ids = numpy.zeros(len(indexes), numpy.int32)
+    frame_ids[1:] = numpy.cumsum(indexes[1:] < indexes[:-1])
+    frame_count = int(frame_ids[-1]) + 1 if len(indexes) else 0
+    
+    # The bone names are resolved against the skeleton. From there on the
+    #     keys are stored by skeleton bone index only.
+    remap = numpy.full(int(indexes.max()) + 1 if len(indexes) else 0, -1, numpy.int32)
+    for index, bone_name in sorted(names.items()):
+        try:
+            remap[index] = bone_ids[bone_name]
+        except KeyError:
+            print("Animation '" + animation.name + "': Bone '" + bone_name + "' is not in the skeleton. Skipping its keys.")
+            continue
+        if remap[index] != index:
+            print("Animation '" + animation.name + "': Bone '" + bone_name + "' is index " + str(index) + " in the file, using skeleton index " + str(remap[index]) + ".")
+    indexes = remap[indexes]
+    known   = indexes >= 0
+    if not known.all():
+        indexes, frame_ids, times, locs, rots = indexes[known], frame_ids[known], times[known], locs[known], rots[known]
+    
+    bone_count = len(animation.bone_names)
+    animation.frame_count = frame_count
+    animation.times       = numpy.zeros((frame_count, bone_count), numpy.float32)
+    animation.locs        = numpy.zeros((frame_count, bone_count, 3), numpy.float32)
+    animation.rots        = numpy.zeros((frame_count, bone_count, 4), numpy.float32)
+    animation.rots[:, :, 3] = 1.0
+    animation.keyed       = numpy.zeros((frame_count, bone_count), bool)
+    
+    animation.times[frame_ids, indexes] = times
+    animation.locs [frame_ids, indexes] = locs
+    animation.rots [frame_ids, indexes] = rots
+    animation.keyed[frame_ids, indexes] = True
+
+
+#####################################################################################
+###                                                                               ###
+###   Parse cache                                                                 ###
+###                                                                               ###
+#####################################################################################
+
+# Changed whenever the parser or the layout of the cached arrays changes, so
+#     files cached by an older version are parsed again.
+CACHE_VERSION = 2
+
+
+# Parsed files are kept in the cache directory as one .npz per file, named by
+#     the digest of the file content and of the parse options. An index maps
+#     each source path to its size, mtime and digest, so an unchanged file is
+#     not hashed again. Entries are dropped least recently used first (by
+#     mtime, which is refreshed on every hit) once the cap is passed.
+class ParseCache:
+    
+    def __init__(self, directory, max_size):
+        self.directory  = directory
+        self.max_size   = max_size
+        self.index_path = os.path.join(directory, "index.json")
+    
+    def key(self, filepath, options):
+        filepath = os.path.abspath(filepath)
+        stat     = os.stat(filepath)
+        index    = self.read_index()
+        entry    = index.get(filepath)
+        if entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            digest = entry[2]
+        else:
+            digest = file_digest(filepath)
+            index[filepath] = [stat.st_size, stat.st_mtime, digest]
+            self.write_index(index)
+        options = "cache=" + str(CACHE_VERSION) + " " + options
+        return digest + "-" + hashlib.md5(options.encode("utf-8")).hexdigest()[:8]
+    
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+    
+    def load(self, key, z):
+        path = self.path(key)
+        try:
+            with numpy.load(path) as arrays:
+                load_z_mesh(arrays, z)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        # Used just now. (LRU)
+        try:
+            os.utime(path, None)
+        except OSError:
+            ok = None
+        return True
+    
+    def store(self, key, z):
+        path = self.path(key)
+        # Batch import workers may store at the same time.
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with io.open(temp, 'wb') as file:
+                numpy.savez(file, **save_z_mesh(z))
+            os.replace(temp, path)
+        except (IOError, OSError):
+            # Read-only folder or full disk, the file is just not cached.
+            ok = None
+            return
+        # The file is cached either way, trimming is only housekeeping.
+        try:
+            self.evict()
+        except (IOError, OSError):
+            ok = None
+    
+    def evict(self):
+        entries = [ ]
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                # Another worker may have evicted it since the listing.
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                ok = None
+    
+    def read_index(self):
+        try:
+            with io.open(self.index_path, 'r') as file:
+                return json.load(file)
+        except (IOError, OSError, ValueError):
+            return dict()
+    
+    def write_index(self, index):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temp = self.index_path + "." + str(os.getpid()) + ".tmp"
+            with io.open(temp, 'w') as file:
+                file.write(json.dumps(index))
+            os.replace(temp, self.index_path)
+        except (IOError, OSError):
+            ok = None
+
+
+def file_digest(filepath):
+    digest = hashlib.md5()
+    with io.open(filepath, 'rb') as file:
+        chunk = file.read(MAP_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = file.read(MAP_CHUNK_SIZE)
+    return digest.hexdigest()
+
+def default_cache_directory():
+    return os.path.join(tempfile.gettempdir(), "zomboid_cache")
+
+
+# The parsed arrays of a ZMesh, its Skeleton and Animations, as the named
+#     arrays of one .npz. Everything that is not an array goes in "meta".
+def save_z_mesh(z):
+    s = z.skeleton
+    arrays = {
+        "faces"          : z.faces,
+        "bone_parent"    : s.bone_parent,
+        "bind_matrix"    : s.bind_matrix,
+        "offset_matrix"  : s.offset_matrix,
+        }
+    # The vertex arrays are the stride elements themselves, each is stored
+    #     once. (The bone ids of BlendIndexArray only as integers)
+    for type, array in z.elements.items():
+        if type == "BlendIndexArray":
+            array = z.weight_indexes
+        arrays["element/" + type] = array
+    animations = [ ]
+    for index, animation in enumerate(z.animations):
+        animations.append([animation.name, animation.time, animation.key_count, animation.frame_count])
+        arrays["animation/%d/times" % index] = animation.times
+        arrays["animation/%d/locs"  % index] = animation.locs
+        arrays["animation/%d/rots"  % index] = animation.rots
+        arrays["animation/%d/keyed" % index] = animation.keyed
+    arrays["meta"] = numpy.array(json.dumps({
+        "name"            : z.name,
+        "version"         : z.version,
+        "element_count"   : z.element_count,
+        "stride_type"     : z.stride_type,
+        "elements"        : list(z.elements.keys()),
+        "vertex_count"    : z.vertex_count,
+        "face_count"      : z.face_count,
+        "animation_count" : z.animation_count,
+        "has_texture"     : z.has_texture,
+        "has_armature"    : z.has_armature,
+        "load_armature"   : z.load_armature,
+        "has_animations"  : z.has_animations,
+        "has_weights"     : z.has_weights,
+        "bone_count"      : s.bone_count,
+        "bone_name"       : s.bone_name,
+        "animations"      : animations,
+        }))
+    return arrays
+
+
+def load_z_mesh(arrays, z):
+    meta = json.loads(str(arrays["meta"]))
+    s = z.skeleton
+    z.name            = meta["name"]
+    z.version         = meta["version"]
+    z.element_count   = meta["element_count"]
+    z.stride_type     = meta["stride_type"]
+    z.vertex_count    = meta["vertex_count"]
+    z.face_count      = meta["face_count"]
+    z.animation_count = meta["animation_count"]
+    z.has_texture     = meta["has_texture"]
+    z.has_armature    = meta["has_armature"]
+    z.load_armature   = meta["load_armature"]
+    z.has_animations  = meta["has_animations"]
+    z.has_weights     = meta["has_weights"]
+    z.elements        = dict((type, arrays["element/" + type]) for type in meta["elements"])
+    z.faces           = arrays["faces"]
+    # Same aliases as store_vertex_arrays(), the UVs are stored flipped.
+    if "VertexArray" in z.elements:
+        z.vertices       = z.elements["VertexArray"]
+    if "TextureCoordArray" in z.elements:
+        z.uvs            = z.elements["TextureCoordArray"]
+    if "BlendWeightArray" in z.elements:
+        z.weight_values  = z.elements["BlendWeightArray"]
+    if "BlendIndexArray" in z.elements:
+        z.weight_indexes = z.elements["BlendIndexArray"]
+        z.elements["BlendIndexArray"] = z.weight_indexes.astype(numpy.float32)
+    if z.has_texture and len(z.faces):
+        z.face_uvs    = z.uvs[z.faces]
+    
+    s.bone_count      = meta["bone_count"]
+    s.bone_name       = meta["bone_name"]
+    s.bone_index      = dict((bone_name, index) for index, bone_name in enumerate(s.bone_name))
+    s.bone_parent     = arrays["bone_parent"]
+    s.bind_matrix     = arrays["bind_matrix"]
+    s.offset_matrix   = arrays["offset_matrix"]
+    if z.has_armature:
+        s.topology    = SkeletonTopology(s.bone_parent)
+    
+    z.animations      = [ ]
+    for index, (name, time, key_count, frame_count) in enumerate(meta["animations"]):
+        animation             = Animation(name, time, key_count, s.bone_name)
+        animation.frame_count = frame_count
+        animation.times       = arrays["animation/%d/times" % index]
+        animation.locs        = arrays["animation/%d/locs"  % index]
+        animation.rots        = arrays["animation/%d/rots"  % index]
+        animation.keyed       = arrays["animation/%d/keyed" % index]
+        z.animations.append(animation)
+
+
+#####################################################################################
+###                                                                               ###
+###   Pose math                                                                   ###
+###                                                                               ###
+#####################################################################################
+
+# Rotation matrices for a batch of quaternions, the same as
+#     create_from_quaternion() does one Matrix4f at a time.
+# -- quaternions: ... x XYZW (Normalised here)
+def quaternion_to_matrix(quaternions):
+    q = numpy.array(quaternions, dtype=numpy.float64)
+    length = numpy.sqrt(numpy.sum(q * q, axis=-1))
+    q[length > 0.0] /= length[length > 0.0, None]
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    
+    m = numpy.empty(q.shape[:-1] + (3, 3), numpy.float64)
+    m[..., 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    m[..., 0, 1] =       2.0 * (x * y - z * w)
+    m[..., 0, 2] =       2.0 * (x * z + y * w)
+    m[..., 1, 0] =       2.0 * (x * y + z * w)
+    m[..., 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    m[..., 1, 2] =       2.0 * (y * z - x * w)
+    m[..., 2, 0] =       2.0 * (x * z - y * w)
+    m[..., 2, 1] =       2.0 * (y * z + x * w)
+    m[..., 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    return m
+
+# Quaternions (W, X, Y, Z) of a batch of 3x3 rotation matrices, the same as
+#     Matrix.to_quaternion(). Each one uses the best conditioned of the four
+#     usual formulas.
+def matrix_to_quaternion(matrices):
+    m = numpy.array(matrices, dtype=numpy.float64)
+    # Take the scale out first.
+    m /= numpy.sqrt(numpy.sum(m * m, axis=-2))[..., None, :]
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    
+    candidates = numpy.array((
+        (1.0 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01),
+        (m21 - m12, 1.0 + m00 - m11 - m22, m01 + m10, m02 + m20),
+        (m02 - m20, m01 + m10, 1.0 - m00 + m11 - m22, m12 + m21),
+        (m10 - m01, m02 + m20, m12 + m21, 1.0 - m00 - m11 + m22)))
+    pick = numpy.argmax(numpy.array((m00 + m11 + m22, m00, m11, m22)), axis=0)
+    
+    # candidates is 4 (formula) x 4 (component) x ..., the picked formula's
+    #     own component is the largest, and gives the scale (4 * q^2).
+    q = numpy.empty(m.shape[:-2] + (4,), numpy.float64)
+    for component in range(0, 4):
+        q[..., component] = numpy.choose(pick, candidates[:, component])
+    diagonal = numpy.choose(pick, (candidates[0, 0], candidates[1, 1], candidates[2, 2], candidates[3, 3]))
+    q /= (2.0 * numpy.sqrt(diagonal))[..., None]
+    return q
+
+# Skin matrices of every bone for every frame of an animation, the batched
+#     form of bone_pose -> world_pose -> skin_pose. Bones are worked out one
+#     hierarchy level at a time over all frames together.
+# -- locations: FRAME_COUNT x BONE_ID x XYZ
+# -- rotations: FRAME_COUNT x BONE_ID x XYZW
+# -- keyed:     FRAME_COUNT x BONE_ID (False frames hold the last key)
+# -- topology:  SkeletonTopology
+# -- offsets:   BONE_ID x 4 x 4
+# Returns FRAME_COUNT x BONE_ID x 4 x 4, in Blender's row layout.
+def evaluate_poses(locations, rotations, keyed, topology, offsets):
+    frame_count, bone_count = keyed.shape
+    
+    # Frame each bone takes its key from. (Frame 0 holds the identity key
+    #     for bones that have not been keyed yet)
+    source = numpy.where(keyed, numpy.arange(frame_count)[:, None], 0)
+    source = numpy.maximum.accumulate(source, axis=0)
+    bones  = numpy.arange(bone_count)[None, :]
+    
+    local = numpy.zeros((frame_count, bone_count, 4, 4), numpy.float64)
+    local[:, :, :3, :3] = quaternion_to_matrix(rotations[source, bones])
+    local[:, :, :3, 3]  = locations[source, bones]
+    local[:, :, 3, 3]   = 1.0
+    
+    # Roots keep their local pose, each level below only needs the one above.
+    world = local.copy()
+    for level_bones in topology.levels[1:]:
+        world[:, level_bones] = numpy.einsum('fbij,fbjk->fbik', world[:, topology.parents[level_bones]], local[:, level_bones])
+    
+    return numpy.einsum('fbij,bjk->fbik', world, numpy.asarray(offsets, dtype=numpy.float64))
+
+# Frames a channel needs a key on to hold its value between changes: the
+#     frames where it changes, the frame before each, and both ends.
+# -- values: FRAME_COUNT x BONE x N
+def changed_keys(values):
+    changed = numpy.any(values[1:] != values[:-1], axis=-1)
+    keep = numpy.zeros(values.shape[:2], bool)
+    keep[1:]  |= changed
+    keep[:-1] |= changed
+    keep[0] = keep[-1] = True
+    return keep
+
+# Drops the keys that linear interpolation between the keys left around
+#     them reproduces within 'tolerance', for every bone at once. Each pass
+#     tries to drop every other kept key (so no two neighbours go in the
+#     same pass), and keeps a key if any frame it covered would be off.
+#     Quaternions are compared by angle, after normalising like Blender
+#     does with linearly interpolated rotation channels.
+# -- values:   FRAME_COUNT x BONE x N
+# -- keep:     FRAME_COUNT x BONE (Keys to start from)
+# -- rotation: True for WXYZ values and an angle tolerance (Radians)
+def decimate_keys(values, keep, tolerance, rotation=False):
+    frame_count, bone_count = keep.shape
+    keep = keep.copy()
+    if frame_count < 3:
+        return keep
+    keep[0] = keep[-1] = True
+    
+    frames = numpy.arange(frame_count)[:, None]
+    bones  = numpy.arange(bone_count)[None, :]
+    if rotation:
+        target = values / numpy.sqrt(numpy.sum(values * values, axis=-1))[..., None]
+    
+    parity = 1
+    idle   = 0
+    while idle < 2:
+        rank       = numpy.cumsum(keep, axis=0)
+        candidates = keep & (rank % 2 == parity)
+        candidates[0] = candidates[-1] = False
+        parity ^= 1
+        if not candidates.any():
+            idle += 1
+            continue
+        
+        # Keys left around each frame if the candidates go.
+        trial    = keep & ~candidates
+        previous = numpy.maximum.accumulate(numpy.where(trial, frames, 0), axis=0)
+        next     = numpy.minimum.accumulate(numpy.where(trial, frames, frame_count - 1)[::-1], axis=0)[::-1]
+        factor   = (frames - previous) / numpy.maximum(next - previous, 1).astype(numpy.float64)
+        
+        start    = values[previous, bones]
+        guess    = start + (values[next, bones] - start) * factor[..., None]
+        if rotation:
+            guess  = guess / numpy.sqrt(numpy.sum(guess * guess, axis=-1))[..., None]
+            cosine = numpy.clip(numpy.abs(numpy.sum(guess * target, axis=-1)), 0.0, 1.0)
+            error  = 2.0 * numpy.arccos(cosine)
+        else:
+            error  = numpy.sqrt(numpy.sum((guess - values) ** 2, axis=-1))
+        
+        # A frame that is off marks the key its segment starts from, and a
+        #     candidate stays if the segment it would fall into is marked.
+        off = numpy.zeros((frame_count, bone_count), bool)
+        bad_frames, bad_bones = numpy.nonzero(error > tolerance)
+        off[previous[bad_frames, bad_bones], bad_bones] = True
+        remove = candidates & ~off[previous, bones]
+        
+        if remove.any():
+            keep &= ~remove
+            idle  = 0
+        else:
+            idle += 1
+    return keep